@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import threading
+import logging
+import time
+
+import sirius
+
+
+class Account():
+    """
+    One SiriusXM login with its own session and token cache
+    Keeps the load and error counters reported by AccountPool.status
+    """
+    def __init__(self, username, password, sxm):
+        self.username = username
+        self.password = password
+        self.sxm = sxm
+        self.channels = []
+        self.segments = 0
+        self.errors = 0
+        self.last_error = None
+        self.failed_until = 0
+        self.logged_in = False
+
+
+    def login(self):
+        logging.info('Signing in with username "{}"'.format(self.username))
+        self.sxm.login(self.username, self.password)
+        self.logged_in = True
+
+
+class AccountPool():
+    """
+    Spreads channels over several accounts, least loaded first
+
+    An account whose session fails is benched for FAILURE_COOLDOWN seconds,
+    and the channels it was carrying move to other accounts on their retry.
+    While every account is benched nothing signs in, so a bad password is
+    not retried upstream faster than once per cooldown.
+    """
+    FAILURE_COOLDOWN = 60
+
+
+    def __init__(self, template, credentials):
+        self._lock = threading.Lock()
+        self.accounts = []
+        error = None
+        for index, (username, password) in enumerate(credentials):
+            # the first account reuses the template session
+            sxm = template if index == 0 else sirius.Sirius(template)
+            account = Account(username, password, sxm)
+            try:
+                account.login()
+            except Exception as e:
+                self._fail(account, e)
+                error = e
+            self.accounts.append(account)
+
+        if not any(x.logged_in for x in self.accounts):
+            # as with a single account, nothing to serve with is a startup error
+            raise error
+
+
+    def _fail(self, account, error):
+        account.errors += 1
+        account.last_error = str(error)
+        account.failed_until = time.time() + self.FAILURE_COOLDOWN
+        logging.warning('Account "{}" failed, benched for {} s: {}'.format(
+            account.username, self.FAILURE_COOLDOWN, error))
+
+
+    def acquire(self, channel_key):
+        """Assigns a channel to the least loaded healthy account and returns it"""
+        with self._lock:
+            now = time.time()
+            healthy = [x for x in self.accounts if x.failed_until <= now]
+            if not healthy:
+                wait = min(x.failed_until for x in self.accounts) - now
+                raise sirius.SiriusAuthException(
+                    'Every account is resting after failures, for {:.0f} s more'.format(wait))
+            account = min(healthy, key=lambda x: len(x.channels))
+            account.channels.append(channel_key)
+
+        if not account.logged_in:
+            try:
+                account.login()
+            except Exception as e:
+                self.release(account, channel_key)
+                self.fail(account, e)
+                raise
+        return account
+
+
+    def release(self, account, channel_key):
+        with self._lock:
+            if channel_key in account.channels:
+                account.channels.remove(channel_key)
+
+
+    def fail(self, account, error):
+        with self._lock:
+            self._fail(account, error)
+            account.logged_in = False
+
+
+    def load(self):
+        """Returns how many channels are assigned and how many accounts are healthy"""
+        now = time.time()
+        with self._lock:
+            return (sum(len(x.channels) for x in self.accounts),
+                    len([x for x in self.accounts if x.failed_until <= now]))
+
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            return [{
+                'username': account.username,
+                'channels': len(account.channels),
+                'segments': account.segments,
+                'errors': account.errors,
+                'last_error': account.last_error,
+                'available': account.failed_until <= now,
+            } for account in self.accounts]
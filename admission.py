@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import logging
+import struct
+import os
+
+import shared
+
+try:
+    import fcntl
+    import termios
+    TIOCOUTQ = termios.TIOCOUTQ
+except (ImportError, AttributeError):
+    # not available on this platform, backlog checks are skipped
+    TIOCOUTQ = None
+
+
+class Refused(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return self.value
+
+
+def send_backlog(sock):
+    """Bytes queued in the kernel for sock but not yet sent, or None if unknown"""
+    if TIOCOUTQ is None:
+        return None
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), TIOCOUTQ, b'\0' * 4))[0]
+    except OSError:
+        return None
+
+
+class Ticket():
+    """A listener's place, to be released exactly once when it leaves"""
+    def __init__(self, admission, channel_key):
+        self.admission = admission
+        self.channel_key = channel_key
+        self.released = False
+
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.admission.leave(self.channel_key)
+
+
+class Admission():
+    """
+    Decides who may start listening and who has fallen too far behind
+
+    Any limit set to 0 is off. upstream_load is a callable returning how many
+    channels are being fetched from SiriusXM and how many accounts can take
+    more, so a listener that would need another upstream fetch is refused
+    when that is at max_upstream or no account is available. With workers
+    pre-forked, max_listeners counts the listeners of all of them, while
+    max_channel_listeners holds per worker.
+    """
+    def __init__(self, upstream_load, max_listeners=0, max_channel_listeners=0,
+            max_load=0, max_upstream=0, retry_after=10, send_timeout=30,
+            max_send_backlog=0, max_lag=0, slow_listeners='skip', workers=1):
+        self.upstream_load = upstream_load
+        self.max_listeners = max_listeners
+        self.max_channel_listeners = max_channel_listeners
+        self.max_load = max_load
+        self.max_upstream = max_upstream
+        self.retry_after = retry_after
+        self.send_timeout = send_timeout or None
+        self.max_send_backlog = max_send_backlog
+        self.max_lag = max_lag
+        self.slow_listeners = slow_listeners
+        self.listeners = collections.Counter()
+        self.total = shared.WorkerCounts(workers)
+        self._lock = threading.Lock()
+
+
+    def upstream_saturated(self):
+        """Why another upstream fetch cannot start, or None if it can"""
+        channels, available = self.upstream_load()
+        if self.max_upstream and channels >= self.max_upstream:
+            return 'Fetching {} channels upstream already'.format(channels)
+        if not available:
+            return 'No SiriusXM account available'
+        return None
+
+
+    def _saturated(self, needs_upstream):
+        if self.max_load:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            if load > self.max_load:
+                return 'CPU load {:.2f} per core'.format(load)
+        if needs_upstream:
+            return self.upstream_saturated()
+        return None
+
+
+    def enter(self, channel_key, needs_upstream=False):
+        """Returns a Ticket for a new listener, or raises Refused"""
+        reason = self._saturated(needs_upstream)
+        with self._lock:
+            if reason is None and self.max_listeners and self.total.total() >= self.max_listeners:
+                reason = 'Server is full'
+            if reason is None and self.max_channel_listeners and self.listeners[channel_key] >= self.max_channel_listeners:
+                reason = 'Channel is full'
+            if reason is not None:
+                logging.warning('Refusing listener for %s: %s', channel_key, reason)
+                raise Refused(reason)
+            self.listeners[channel_key] += 1
+            self.total.add()
+        return Ticket(self, channel_key)
+
+
+    def leave(self, channel_key):
+        with self._lock:
+            self.listeners[channel_key] -= 1
+            self.total.add(-1)
+            if self.listeners[channel_key] <= 0:
+                del self.listeners[channel_key]
+
+
+    def behind(self, sock, segments):
+        """
+        Whether a listener is falling behind: too much unsent data queued on
+        its socket, or too many segments behind the newest one
+        """
+        if self.max_lag and segments.lag > self.max_lag:
+            return True
+        if self.max_send_backlog:
+            backlog = send_backlog(sock)
+            if backlog is not None and backlog > self.max_send_backlog:
+                return True
+        return False
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+'''
+Shared-memory audio bus between pre-forked worker processes
+
+Each live channel tier is owned by one worker, picked by hashing its key.
+The owner fetches it as usual and also publishes every segment (TS and
+metadata) into a ring in shared memory. Other workers read the ring instead
+of fetching, and keep the owner fetching by sending demand messages to its
+inbox for as long as they have listeners. A demand also says whether the
+reader has listeners that want audio; while any does, the owner demuxes
+each segment once and publishes the ADTS audio with it. Channels with only
+TS listeners are never demuxed.
+'''
+import hashlib
+import json
+import logging
+import queue
+import struct
+import threading
+import time
+import glob
+import os
+
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+import pipeline
+
+
+class BusException(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class Ring():
+    """
+    Fixed number of fixed size slots in shared memory, one writer, many readers
+
+    The header holds the newest sequence number. A slot holds its sequence
+    number, field lengths, then the segment name, metadata JSON, TS data and
+    audio. The writer zeroes a slot's sequence before rewriting it, so readers
+    can tell a torn read by checking the sequence again after copying.
+    """
+    SLOTS = 8
+    SLOT_SIZE = 1 << 20
+    HEADER = struct.Struct('!Q')
+    SLOT_HEADER = struct.Struct('!QIIII')
+
+
+    def __init__(self, name, create=False):
+        size = self.HEADER.size + self.SLOTS * self.SLOT_SIZE
+        if create:
+            try:
+                self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+                self.shm.buf[:self.HEADER.size] = self.HEADER.pack(0)
+            except FileExistsError:
+                # left by an earlier owner, carry on from its sequence numbers
+                self.shm = shared_memory.SharedMemory(name)
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+        # lifetime is managed by the bus, not by multiprocessing's tracker
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+
+    def _slot(self, sequence):
+        return self.HEADER.size + (sequence % self.SLOTS) * self.SLOT_SIZE
+
+
+    def newest(self):
+        return self.HEADER.unpack_from(self.shm.buf, 0)[0]
+
+
+    def write(self, segment, audio=False):
+        """Writes a segment, with its audio if wanted or already demuxed"""
+        name = segment.name.encode('utf-8')
+        metadata = json.dumps(segment.metadata).encode('utf-8')
+        data = segment.data or b''
+        audio = segment.audio if audio or segment.demuxed else b''
+        length = self.SLOT_HEADER.size + len(name) + len(metadata) + len(data) + len(audio)
+        if length > self.SLOT_SIZE:
+            logging.warning('Segment %s too large for the audio bus (%d b)', segment.name, length)
+            return
+
+        sequence = self.newest() + 1
+        offset = self._slot(sequence)
+        buf = self.shm.buf
+        self.SLOT_HEADER.pack_into(buf, offset, 0, len(name), len(metadata), len(data), len(audio))
+        position = offset + self.SLOT_HEADER.size
+        for part in (name, metadata, data, audio):
+            buf[position:position + len(part)] = part
+            position += len(part)
+        struct.pack_into('!Q', buf, offset, sequence)
+        self.HEADER.pack_into(buf, 0, sequence)
+
+
+    def read(self, sequence):
+        """Returns the Segment with this sequence number, or None if it is gone"""
+        offset = self._slot(sequence)
+        buf = self.shm.buf
+        found, name_length, metadata_length, data_length, audio_length = \
+            self.SLOT_HEADER.unpack_from(buf, offset)
+        if found != sequence:
+            return None
+        position = offset + self.SLOT_HEADER.size
+        parts = []
+        for length in (name_length, metadata_length, data_length, audio_length):
+            parts.append(bytes(buf[position:position + length]))
+            position += length
+        if struct.unpack_from('!Q', buf, offset)[0] != sequence:
+            return None
+        name, metadata, data, audio = parts
+        return pipeline.Segment(name.decode('utf-8'), data or None, audio or None,
+            json.loads(metadata.decode('utf-8')))
+
+
+    def close(self):
+        self.shm.close()
+
+
+class AudioBus():
+    """
+    One worker's end of the bus
+
+    inboxes holds one multiprocessing queue per worker, created before
+    forking. pin(channel_number, bitrate, audio) must return a subscription
+    that keeps the channel tier's pipeline running until it is closed, as a
+    listener that wants audio or not.
+    """
+    POLL_INTERVAL = 0.25
+    DEMAND_INTERVAL = 5
+    LEASE = 20
+    STALE_TIMEOUT = 60
+
+
+    def __init__(self, index, count, port, inboxes, pin):
+        self.index = index
+        self.count = count
+        self.port = port
+        self.inboxes = inboxes
+        self.pin = pin
+        self.leases = {}
+
+
+    def start(self):
+        thread = threading.Thread(target=self._serve_demand, daemon=True)
+        thread.start()
+
+
+    def ring_name(self, key):
+        return 'seriouscast-{}-{}'.format(self.port, hashlib.md5(key.encode()).hexdigest()[:16])
+
+
+    def owner(self, key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:8], 16) % self.count
+
+
+    def is_owner(self, key):
+        return self.owner(key) == self.index
+
+
+    def publish(self, key, segments, wants_audio):
+        """
+        Passes segments through, writing each into the key's ring
+        Audio goes with them while wants_audio() says a listener wants it
+        """
+        ring = Ring(self.ring_name(key), create=True)
+        try:
+            for segment in segments:
+                ring.write(segment, wants_audio())
+                yield segment
+        finally:
+            ring.close()
+
+
+    def _demand(self, key, channel_number, bitrate, audio):
+        try:
+            self.inboxes[self.owner(key)].put_nowait((key, channel_number, bitrate, audio))
+        except queue.Full:
+            pass
+
+
+    def read(self, key, channel_number, bitrate, wants_audio):
+        """
+        Generator of Segments from another worker's ring for key
+        The owner is asked for audio while wants_audio() says so
+        """
+        audio = wants_audio()
+        self._demand(key, channel_number, bitrate, audio)
+        last_demand = last_new = time.time()
+        ring = None
+        while ring is None:
+            try:
+                ring = Ring(self.ring_name(key))
+            except FileNotFoundError:
+                if time.time() - last_new > self.STALE_TIMEOUT:
+                    raise BusException('Worker {} never published {}'.format(self.owner(key), key))
+                time.sleep(self.POLL_INTERVAL)
+
+        try:
+            position = max(1, ring.newest() - Ring.SLOTS + 2)
+            while True:
+                now = time.time()
+                if now - last_demand > self.DEMAND_INTERVAL or wants_audio() != audio:
+                    audio = wants_audio()
+                    self._demand(key, channel_number, bitrate, audio)
+                    last_demand = now
+
+                newest = ring.newest()
+                position = max(position, newest - Ring.SLOTS + 2)
+                while position <= newest:
+                    segment = ring.read(position)
+                    position += 1
+                    if segment is not None:
+                        last_new = time.time()
+                        yield segment
+
+                if time.time() - last_new > self.STALE_TIMEOUT:
+                    # the owner went away, start over with a fresh mapping
+                    raise BusException('Nothing new on the audio bus for {}'.format(key))
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            ring.close()
+
+
+    def _serve_demand(self):
+        """Keeps pipelines that other workers read from running while wanted"""
+        inbox = self.inboxes[self.index]
+        while True:
+            try:
+                key, channel_number, bitrate, audio = inbox.get(timeout=self.DEMAND_INTERVAL)
+                if key not in self.leases:
+                    logging.info('Audio bus: publishing %s for other workers', key)
+                    self.leases[key] = {'channel_number': channel_number, 'bitrate': bitrate,
+                        'subscription': None, 'until': 0, 'audio_until': 0}
+                lease = self.leases[key]
+                lease['until'] = time.time() + self.LEASE
+                if audio:
+                    lease['audio_until'] = lease['until']
+            except queue.Empty:
+                pass
+            except Exception:
+                logging.exception('Audio bus: demand failed')
+
+            now = time.time()
+            for key in [x for x in self.leases if self.leases[x]['until'] < now]:
+                logging.info('Audio bus: %s no longer wanted by other workers', key)
+                subscription = self.leases.pop(key)['subscription']
+                if subscription is not None:
+                    subscription.close()
+
+            for key, lease in self.leases.items():
+                # pinned as a listener that wants audio while some reader does
+                audio = lease['audio_until'] >= now
+                old = lease['subscription']
+                if old is not None and old.audio == audio:
+                    continue
+                try:
+                    lease['subscription'] = self.pin(lease['channel_number'], lease['bitrate'], audio)
+                except Exception:
+                    logging.exception('Audio bus: could not pin %s', key)
+                    continue
+                # the new one is open first, so the pipeline never goes idle
+                if old is not None:
+                    old.close()
+
+
+def inboxes(count):
+    """One demand queue per worker, to be created before forking"""
+    context = multiprocessing.get_context('fork')
+    return [context.Queue(1000) for x in range(count)]
+
+
+def cleanup(port):
+    """Removes every ring left for this port (Linux keeps them in /dev/shm)"""
+    for path in glob.glob('/dev/shm/seriouscast-{}-*'.format(port)):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import bisect
+import hashlib
+import json
+import socket
+import threading
+import logging
+import time
+
+import requests
+import urllib3
+
+import pipeline
+
+
+class ClusterException(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class Cluster():
+    """
+    Assigns each channel to one owner node by consistent hashing
+
+    Nodes are 'host:port' strings. Only nodes that answer health checks are
+    placed on the ring, so when a node disappears its channels move to the
+    remaining nodes and every other channel stays where it was.
+    """
+    REPLICAS = 64
+    CHECK_INTERVAL = 5
+    CHECK_TIMEOUT = 2
+    FEED_TIMEOUT = 60
+
+
+    def __init__(self, node, nodes=()):
+        self.node = node
+        self.nodes = sorted(set(nodes) | {node})
+        self.live = set(self.nodes)
+        self._lock = threading.Lock()
+        self._addresses = set()
+        self._resolved = 0
+        self._build_ring()
+
+
+    def start(self):
+        """Starts health checks, only needed with other nodes to check"""
+        if len(self.nodes) > 1:
+            logging.info('Cluster mode as {} with nodes {}'.format(self.node, ', '.join(self.nodes)))
+            thread = threading.Thread(target=self._monitor, daemon=True)
+            thread.start()
+
+
+    def _build_ring(self):
+        ring = []
+        for node in self.live:
+            for replica in range(self.REPLICAS):
+                ring.append((self._hash('{}#{}'.format(node, replica)), node))
+        ring.sort()
+        self._ring = ring
+        self._points = [point for point, node in ring]
+
+
+    def _hash(self, value):
+        return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+
+    def _set_live(self, node, alive):
+        with self._lock:
+            if alive == (node in self.live) or node == self.node:
+                return
+            if alive:
+                logging.info('Cluster node {} is up'.format(node))
+                self.live.add(node)
+            else:
+                logging.warning('Cluster node {} is down'.format(node))
+                self.live.discard(node)
+            self._build_ring()
+
+
+    def _monitor(self):
+        """Periodically pings every other node and rebalances on changes"""
+        while True:
+            for node in self.nodes:
+                if node == self.node:
+                    continue
+                try:
+                    resp = requests.get(self.url(node, 'cluster/ping'), timeout=self.CHECK_TIMEOUT)
+                    self._set_live(node, resp.status_code == 200)
+                except requests.RequestException:
+                    self._set_live(node, False)
+            time.sleep(self.CHECK_INTERVAL)
+
+
+    def url(self, node, path):
+        return 'http://{}/{}'.format(node, path)
+
+
+    def owner(self, channel_key):
+        """Returns the node that should fetch channel_key from upstream"""
+        with self._lock:
+            index = bisect.bisect(self._points, self._hash(str(channel_key)))
+            return self._ring[index % len(self._ring)][1]
+
+
+    def is_owner(self, channel_key):
+        return self.owner(channel_key) == self.node
+
+
+    def is_peer(self, address):
+        """
+        Whether an IP address belongs to one of the other configured nodes,
+        always False outside cluster mode. Node host names are looked up
+        again at most every CHECK_INTERVAL seconds, when an address misses.
+        """
+        if len(self.nodes) < 2:
+            return False
+        if address in self._addresses or time.time() - self._resolved < self.CHECK_INTERVAL:
+            return address in self._addresses
+
+        addresses = set()
+        for node in self.nodes:
+            if node == self.node:
+                continue
+            host = node.rpartition(':')[0]
+            try:
+                addresses.update(x[4][0] for x in socket.getaddrinfo(host, None))
+            except OSError as e:
+                logging.warning('Could not look up cluster node {}: {}'.format(node, e))
+        self._addresses = addresses
+        self._resolved = time.time()
+        return address in addresses
+
+
+    def status(self):
+        return {
+            'node': self.node,
+            'nodes': self.nodes,
+            'live': sorted(self.live),
+        }
+
+
+    def feed(self, node, channel_number, rewind=0, bitrate=None, wants_audio=lambda: False):
+        """
+        Generator of Segments pulled from another node's internal feed
+        The owner demuxes the audio for us if wants_audio() says so. Should it
+        start to want audio later, the feed ends so the caller asks again.
+        """
+        path = 'cluster/feed/{}'.format(channel_number)
+        if rewind:
+            path += '/{}'.format(rewind)
+        params = {}
+        if bitrate:
+            params['br'] = bitrate
+        audio_wanted = wants_audio()
+        if audio_wanted:
+            params['audio'] = '1'
+        try:
+            resp = requests.get(self.url(node, path), params=params, stream=True,
+                timeout=self.FEED_TIMEOUT)
+        except requests.RequestException as e:
+            self._set_live(node, False)
+            raise ClusterException('Feed from {} failed: {}'.format(node, e))
+
+        with resp:
+            if resp.status_code == 404:
+                # the owner found upstream lacks this channel or tier, don't retry
+                raise pipeline.SourceUnavailable('Feed from {} not found: channel #{} at {}'.format(
+                    node, channel_number, bitrate or 'the default bitrate'))
+            if resp.status_code != 200:
+                # most likely the nodes disagree about ownership for a moment
+                time.sleep(int(resp.headers.get('Retry-After', self.CHECK_INTERVAL)))
+                raise ClusterException('Feed from {} refused: HTTP {}'.format(node, resp.status_code))
+
+            logging.info('Pulling channel #{} from cluster node {}'.format(channel_number, node))
+            try:
+                while True:
+                    header = resp.raw.readline()
+                    if not header:
+                        return
+                    header = json.loads(header.decode('utf-8'))
+                    data = self._read_exactly(resp.raw, header['ts'])
+                    audio = None
+                    if header['audio'] is not None:
+                        audio = self._read_exactly(resp.raw, header['audio'])
+                    yield pipeline.Segment(header['segment'], data, audio, header['metadata'])
+                    if not audio_wanted and wants_audio():
+                        logging.info('Channel #{} now wanted with audio, asking {} again'.format(
+                            channel_number, node))
+                        return
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                self._set_live(node, False)
+                raise ClusterException('Feed from {} dropped: {}'.format(node, e))
+
+
+    def _read_exactly(self, stream, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = stream.read(length - len(data))
+            if not chunk:
+                raise ClusterException('Feed ended mid-segment')
+            data.extend(chunk)
+        return bytes(data)
+
+
+def encode_segment(segment, audio=False):
+    """
+    Frames a Segment for the internal feed: a JSON header line, then the TS
+    data, then the demuxed audio if the asking node wants it or the segment
+    was demuxed already (its length is null otherwise)
+    """
+    audio = segment.audio if audio or segment.demuxed else None
+    header = json.dumps({
+        'segment': segment.name,
+        'metadata': segment.metadata,
+        'ts': len(segment.data),
+        'audio': len(audio) if audio is not None else None,
+    }).encode('utf-8')
+    return header + b'\n' + segment.data + (audio or b'')
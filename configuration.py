@@ -19,6 +19,11 @@ To make use of this, you must:
       `machine MYHOSTNAME:seriouscast login MYUSERNAME password MYPASSWORD`
       (the ALLCAPS words are what must be replaced with their real values)
 
+To spread channels over several SiriusXM accounts, either add more .netrc
+entries with a suffix, like `machine MYHOSTNAME:seriouscast:2 login ...`, and
+set `accounts=(from .netrc)`, or add sections named `[Account NAME]` with their
+own `username` and `password` to settings.cfg.
+
 Otherwise overwrite settings.cfg with the contents of example_settings.cfg
 and edit as necessary.
 '''
@@ -56,6 +61,44 @@ def configuration(filename='settings.cfg', hostname='localhost', port='30000'):
         config.set('SeriousCast', 'password', password)
     return config
 
+def accounts(config):
+    '''
+    List (username, password) pairs of every configured account
+
+    The SeriousCast section's account always comes first.
+    '''
+    hostname = config.get('SeriousCast', 'hostname')
+    netrc_lookup = '%s:seriouscast' % hostname
+    credentials = [(config.get('SeriousCast', 'username'),
+                    config.get('SeriousCast', 'password'))]
+    authenticators = None
+    if config.get('SeriousCast', 'accounts', fallback='') == '(from .netrc)':
+        authenticators = netrc.netrc()
+        for machine in sorted(authenticators.hosts):
+            if machine.startswith(netrc_lookup + ':'):
+                login, account, password = authenticators.hosts[machine]
+                credentials.append((login, password))
+    for section in config.sections():
+        if not section.startswith('Account '):
+            continue
+        username = config.get(section, 'username')
+        password = config.get(section, 'password')
+        if '(from .netrc)' in (username, password):
+            if authenticators is None:
+                authenticators = netrc.netrc()
+            lookup = '%s:%s' % (netrc_lookup, section[len('Account '):].strip())
+            login, account, netrc_password = authenticators.authenticators(lookup)
+            if username == '(from .netrc)':
+                username = login
+            if password == '(from .netrc)':
+                password = netrc_password
+        credentials.append((username, password))
+    unique = []
+    for username, password in credentials:
+        if username not in [x[0] for x in unique]:
+            unique.append((username, password))
+    return unique
+
 def load(config, filename):
     '''
     Check for existence of configuration file and load it.
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import bisect
+import json
+import threading
+import logging
+import time
+import os
+
+
+class History():
+    """
+    Append-only on-disk log of track changes, one file per channel
+
+    Each line is a JSON list of [timestamp, title, artist, album]. Every
+    channel's file is indexed in memory by timestamp and byte offset, so a
+    since= query is a bisect and a single read. The index follows the file,
+    so other processes may append to it too. Records older than retention
+    seconds are never returned, and are dropped by rewriting the file once
+    they pile up, when the channel is recorded or read, or by the periodic
+    pass start() runs. Lines that do not parse (say one torn by a crash) are
+    skipped.
+    """
+    COMPACT_SLACK = 86400
+    EXPIRE_INTERVAL = 3600
+
+
+    def __init__(self, directory, retention=7 * 86400):
+        self.directory = directory
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._index = {}
+        os.makedirs(directory, exist_ok=True)
+
+
+    def start(self):
+        """Starts expiring old records of every channel, including idle ones"""
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+
+    def _run(self):
+        while True:
+            time.sleep(self.EXPIRE_INTERVAL)
+            for name in os.listdir(self.directory):
+                channel_number, extension = os.path.splitext(name)
+                if extension != '.log' or not channel_number.isdigit():
+                    continue
+                try:
+                    with self._lock:
+                        self._refresh(int(channel_number))
+                        self._expire(int(channel_number), time.time())
+                except Exception:
+                    logging.exception('History: could not expire %s', name)
+
+
+    def _path(self, channel_number):
+        return os.path.join(self.directory, '{}.log'.format(channel_number))
+
+
+    def _parse(self, line):
+        """Returns a line's record, or None if it is damaged"""
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(record, list) or len(record) != 4:
+            return None
+        return record
+
+
+    def _refresh(self, channel_number):
+        """Brings the channel's index up to date with its file, returns it"""
+        path = self._path(channel_number)
+        index = self._index.get(channel_number)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._index.pop(channel_number, None)
+            return None
+
+        if index is None or index['inode'] != stat.st_ino or index['size'] > stat.st_size:
+            index = {'inode': stat.st_ino, 'size': 0, 'times': [], 'offsets': [], 'last': None}
+            self._index[channel_number] = index
+        if index['size'] == stat.st_size:
+            return index
+
+        with open(path, 'rb') as f:
+            f.seek(index['size'])
+            offset = index['size']
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # another process is halfway through appending it
+                    break
+                record = self._parse(line)
+                if record is not None:
+                    index['times'].append(record[0])
+                    index['offsets'].append(offset)
+                    index['last'] = record[1:]
+                elif line.strip():
+                    logging.warning('History: skipping a damaged line in %s', path)
+                offset += len(line)
+            index['size'] = offset
+        return index
+
+
+    def record(self, channel_number, metadata, timestamp=None):
+        """Appends a track change, ignoring metadata equal to the last one"""
+        timestamp = timestamp or time.time()
+        track = (list(metadata) + [''] * 3)[:3]
+        with self._lock:
+            index = self._refresh(channel_number)
+            if index is not None and index['last'] == track:
+                return False
+            line = json.dumps([round(timestamp, 3)] + track).encode('utf-8') + b'\n'
+            with open(self._path(channel_number), 'a+b') as f:
+                if f.seek(0, os.SEEK_END):
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        # a line torn by a crash, end it so it does not swallow this one
+                        line = b'\n' + line
+                f.write(line)
+            self._refresh(channel_number)
+            self._expire(channel_number, timestamp)
+        logging.debug('History: channel #%s now %r', channel_number, track,
+            extra={'channel': channel_number})
+        return True
+
+
+    def _expire(self, channel_number, now):
+        """Compacts a refreshed channel once it holds a day's worth of expired records"""
+        index = self._index.get(channel_number)
+        if index and index['times'] and index['times'][0] < now - self.retention - self.COMPACT_SLACK:
+            self._compact(channel_number, now - self.retention)
+
+
+    def _compact(self, channel_number, cutoff):
+        index = self._index[channel_number]
+        first = bisect.bisect_left(index['times'], cutoff)
+        start = index['offsets'][first] if first < len(index['offsets']) else index['size']
+        path = self._path(channel_number)
+        temporary = path + '.tmp'
+        with open(path, 'rb') as f, open(temporary, 'wb') as out:
+            f.seek(start)
+            out.write(f.read())
+        os.replace(temporary, path)
+        logging.info('History: dropped records before %s for channel #%s', cutoff, channel_number)
+        self._refresh(channel_number)
+
+
+    def since(self, channel_number, since, limit=None):
+        """Track changes at or after since, oldest first, as dicts"""
+        now = time.time()
+        since = max(since, now - self.retention)
+        with self._lock:
+            self._refresh(channel_number)
+            self._expire(channel_number, now)
+            index = self._index.get(channel_number)
+            if index is None:
+                return []
+            start = bisect.bisect_left(index['times'], since)
+            if start == len(index['times']):
+                return []
+            offset, end = index['offsets'][start], index['size']
+            with open(self._path(channel_number), 'rb') as f:
+                f.seek(offset)
+                data = f.read(end - offset)
+
+        tracks = []
+        for line in data.splitlines():
+            record = self._parse(line)
+            if record is None:
+                continue
+            timestamp, title, artist, album = record
+            tracks.append({
+                'time': timestamp,
+                'title': title,
+                'artist': artist,
+                'album': album,
+            })
+        if limit:
+            tracks = tracks[-limit:]
+        return tracks
+
+
+    def recording(self, channel_number, segments):
+        """
+        Passes segments through, recording their track changes
+        A failing history (a full disk, say) is logged, the audio goes on
+        """
+        for segment in segments:
+            try:
+                if segment.metadata:
+                    self.record(channel_number, segment.metadata)
+            except Exception:
+                logging.exception('History: could not record channel #%s', channel_number)
+            yield segment
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+'''
+Logging that stays off the streaming threads
+
+Request threads only put records on a queue; a background listener formats
+them and does the file and console writes. Messages should be logged with
+%-style arguments so that formatting happens on the listener, not the caller.
+Repetitive records tagged with a channel (extra={'channel': ...}) are rate
+limited per channel and message.
+'''
+import atexit
+import collections
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+_setup = {}
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that leaves formatting to the listener and, when the queue
+    is full, drops records instead of blocking the caller
+    '''
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+
+    def prepare(self, record):
+        return record
+
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            note = logging.LogRecord('logutils', logging.WARNING, __file__, 0,
+                'Log queue full, dropped %d records', (dropped,), None)
+            try:
+                self.queue.put_nowait(note)
+            except queue.Full:
+                self.dropped += dropped
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Lets at most burst records per channel and message template through per
+    interval seconds, for records below WARNING that carry a channel. The
+    next record let through says how many were suppressed.
+    '''
+    def __init__(self, burst=5, interval=60):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._suppressed = collections.Counter()
+
+
+    def filter(self, record):
+        channel = getattr(record, 'channel', None)
+        if channel is None or record.levelno >= logging.WARNING:
+            return True
+
+        key = (channel, record.msg)
+        now = time.time()
+        with self._lock:
+            start, count = self._windows.get(key, (now, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            self._windows[key] = (start, count + 1)
+            if count >= self.burst:
+                self._suppressed[key] += 1
+                return False
+            suppressed = self._suppressed.pop(key, 0)
+
+        if suppressed:
+            record.msg = '%s (%d similar suppressed)' % (record.msg, suppressed)
+        return True
+
+
+def setup(filename, level=logging.DEBUG, queue_size=10000, burst=5, interval=60, mode='w'):
+    '''
+    Route all logging through a queue to a background writer thread
+    Returns the running QueueListener, which is also stopped at exit
+    '''
+    file_handler = logging.FileHandler(filename, mode=mode)
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s :: %(levelname)s :: %(thread)d :: %(message)s',
+        datefmt='%m/%d %H:%M'))
+
+    # Set up console logging output
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter('%(levelname)s :: %(thread)-5d :: %(message)s'))
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    handler.addFilter(RateLimitFilter(burst, interval))
+    root = logging.getLogger('')
+    root.setLevel(level)
+    root.addHandler(handler)
+
+    listener = logging.handlers.QueueListener(handler.queue, file_handler, console,
+        respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    _setup.update(handler=handler, listener=listener, args={
+        'filename': filename, 'level': level, 'queue_size': queue_size,
+        'burst': burst, 'interval': interval,
+    })
+    return listener
+
+
+def after_fork():
+    '''
+    Give a forked worker its own queue and writer thread, since threads do
+    not survive a fork. It appends to the same log file as its parent.
+    '''
+    root = logging.getLogger('')
+    root.removeHandler(_setup['handler'])
+    atexit.unregister(_setup['listener'].stop)
+    return setup(mode='a', **_setup['args'])
+
+
+class ListenerSession():
+    '''
+    Counts what one listener connection was sent and logs a single
+    structured summary line when it ends
+    '''
+    STALL_SECONDS = 1
+
+
+    def __init__(self, kind, channel, client):
+        self.kind = kind
+        self.channel = channel
+        self.client = client
+        self.start = time.time()
+        self.bytes_sent = 0
+        self.writes = 0
+        self.stalls = 0
+        self.stalled_seconds = 0
+        self.skips = 0
+        self.reason = 'ended'
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.reason = exc_type.__name__
+        self.close()
+
+
+    def write(self, write, data):
+        '''Calls write(data), counting bytes sent and slow writes'''
+        start = time.time()
+        sent = write(data)
+        elapsed = time.time() - start
+        self.writes += 1
+        self.bytes_sent += sent or 0
+        if elapsed >= self.STALL_SECONDS:
+            self.stalls += 1
+            self.stalled_seconds += elapsed
+        return sent
+
+
+    def close(self):
+        summary = {
+            'kind': self.kind,
+            'channel': self.channel,
+            'client': self.client,
+            'duration': round(time.time() - self.start, 3),
+            'bytes_sent': self.bytes_sent,
+            'writes': self.writes,
+            'stalls': self.stalls,
+            'stalled_seconds': round(self.stalled_seconds, 3),
+            'skips': self.skips,
+            'reason': self.reason,
+        }
+        logging.info('Session summary: %s', json.dumps(summary, sort_keys=True),
+            extra={'session': summary})
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
 import struct
+import collections
 import bitstring
 
 
+AUDIO_PID = 768
+METADATA_PID = 1024
+
+
 def parse_packetized_elementary_stream(data):
     try:
         pes = bitstring.ConstBitStream(data[data.index(b'\x00\x00\x01'):])
@@ -135,6 +140,51 @@ def parse_sxm_metadata(packet):
     return None
 
 
+def demux_segment(data):
+    '''
+    Split a decrypted MPEG-TS segment into ADTS audio and SXM metadata
+    Returns the audio bytes and the last metadata found, or None
+    '''
+    pes_streams = collections.defaultdict(bytearray)
+    for ts_packet in parse_transport_stream(data):
+        if 'payload' in ts_packet:
+            pes_streams[ts_packet['pid']].extend(ts_packet['payload'])
+
+    audio = bytearray()
+    metadata = None
+    for es_packet in parse_packetized_elementary_stream(pes_streams[AUDIO_PID]):
+        audio.extend(es_packet['payload'])
+    for es_packet in parse_packetized_elementary_stream(pes_streams[METADATA_PID]):
+        metadata = parse_sxm_metadata(es_packet['payload']) or metadata
+    return bytes(audio), metadata
+
+
+def segment_metadata(data):
+    '''
+    Find the last SXM metadata in a decrypted MPEG-TS segment, or None
+    Only the metadata packets are parsed, the audio is left alone, so this
+    is far cheaper than demux_segment
+    '''
+    payload = bytearray()
+    start = data.index(b'G')
+    for offset in range(start, len(data), 188):
+        pid = ((data[offset + 1] & 0x1f) << 8) | data[offset + 2]
+        if pid != METADATA_PID:
+            continue
+        flags = data[offset + 3]
+        position = offset + 4
+        if flags & 0x20:
+            # skip the adaptation field
+            position += 1 + data[position]
+        if flags & 0x10:
+            payload.extend(data[position:offset + 188])
+
+    metadata = None
+    for es_packet in parse_packetized_elementary_stream(payload):
+        metadata = parse_sxm_metadata(es_packet['payload']) or metadata
+    return metadata
+
+
 def synchsafe(n):
     bits28 = bitstring.BitArray('uint:28=' + str(n)).bin
     new_bits = '0b'
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import logging
+import tempfile
+import time
+import io
+import os
+
+import mpegutils
+
+
+class SourceUnavailable(Exception):
+    """Raised by a source that will not come back, stops its pipeline"""
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return self.value
+
+
+class Segment():
+    """
+    One media segment of a channel
+
+    Data is the decrypted MPEG-TS. Audio is demuxed from it on first use, at
+    most once, so listeners that only want the TS never pay for demuxing.
+    Metadata (the [title, artist, album] list, or None) comes with the audio,
+    or from a much cheaper parse of the metadata packets alone when it is
+    wanted first. Segments from another node or worker may arrive with both.
+    """
+    def __init__(self, name, data=None, audio=None, metadata=None):
+        self.name = name
+        self.data = data
+        self._audio = audio
+        self._metadata = metadata
+        self._metadata_known = audio is not None or metadata is not None
+        self._lock = threading.Lock()
+        self._spool = None
+        self._discarded = False
+
+
+    def _demux(self):
+        with self._lock:
+            if self._audio is None:
+                self._audio, self._metadata = mpegutils.demux_segment(self.data)
+                self._metadata_known = True
+
+
+    @property
+    def demuxed(self):
+        return self._audio is not None
+
+
+    @property
+    def audio(self):
+        if self._audio is None:
+            self._demux()
+        return self._audio
+
+
+    @property
+    def metadata(self):
+        if not self._metadata_known:
+            with self._lock:
+                if not self._metadata_known:
+                    self._metadata = mpegutils.segment_metadata(self.data)
+                    self._metadata_known = True
+        return self._metadata
+
+
+    def open(self):
+        """
+        Returns a binary file of the TS data, for socket.sendfile
+        The data is spooled to a temporary file the first time
+        """
+        with self._lock:
+            if self._discarded:
+                return io.BytesIO(self.data)
+            if self._spool is None:
+                fd, self._spool = tempfile.mkstemp(prefix='seriouscast-', suffix='.ts')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self.data)
+            return open(self._spool, 'rb')
+
+
+    def discard(self):
+        """Removes the spooled file, open copies stay readable"""
+        with self._lock:
+            self._discarded = True
+            if self._spool is not None:
+                os.unlink(self._spool)
+                self._spool = None
+
+
+class Pipeline():
+    """
+    Fetches a channel once from a single source and fans it out to listeners
+
+    The source is a callable returning an iterable of Segments. It is given
+    the pipeline's wants_audio, so a source that gets segments from elsewhere
+    can ask for them demuxed while any listener wants audio. It is called
+    again whenever that iterable ends or fails, so a source can pick a new
+    origin each time (for instance after a cluster node goes away). The
+    pipeline gives up after FAILURE_LIMIT failures in a row, or at once when
+    the source raises SourceUnavailable; its listeners then get that error.
+    """
+    BACKLOG = 10
+    IDLE_TIMEOUT = 30
+    RETRY_DELAY = 5
+    FAILURE_LIMIT = 3
+    WAIT_TIMEOUT = 60
+
+
+    def __init__(self, registry, key, source):
+        self.key = key
+        self.source = source
+        self.segments = collections.deque(maxlen=self.BACKLOG)
+        self.sequence = 0
+        self.listeners = 0
+        self.audio_listeners = 0
+        self.idle_since = time.time()
+        self.running = True
+        self.error = None
+
+        self._registry = registry
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def wants_audio(self):
+        """Whether any listener wants demuxed audio rather than only the TS"""
+        return self.audio_listeners > 0
+
+
+    def _run(self):
+        logging.info('Pipeline {} started'.format(self.key))
+        failures = 0
+        while self.running:
+            try:
+                for segment in self.source(self.wants_audio):
+                    failures = 0
+                    self._publish(segment)
+                    if self._registry.release_if_idle(self):
+                        break
+            except SourceUnavailable as e:
+                logging.warning('Pipeline {} source unavailable: {}'.format(self.key, e))
+                self._give_up(str(e))
+                break
+            except Exception as e:
+                logging.exception('Pipeline {} source failed'.format(self.key))
+                failures += 1
+                if failures >= self.FAILURE_LIMIT:
+                    self._give_up('Failed {} times in a row: {}'.format(failures, e))
+                    break
+                time.sleep(self.RETRY_DELAY)
+            self._registry.release_if_idle(self)
+
+        with self._condition:
+            for segment in self.segments:
+                segment.discard()
+            self._condition.notify_all()
+        logging.info('Pipeline {} stopped'.format(self.key))
+
+
+    def _give_up(self, error):
+        # set before stopping, listeners woken by the stop raise it
+        self.error = error
+        self._registry.stop(self)
+
+
+    def _publish(self, segment):
+        with self._condition:
+            if len(self.segments) == self.segments.maxlen:
+                self.segments.popleft().discard()
+            self.segments.append(segment)
+            self.sequence += 1
+            self._condition.notify_all()
+
+
+    @property
+    def metadata(self):
+        """The newest now playing metadata in the backlog, or None"""
+        with self._condition:
+            segments = list(self.segments)
+        for segment in reversed(segments):
+            if segment.metadata:
+                return segment.metadata
+        return None
+
+
+class Subscription():
+    """
+    One listener's position in a Pipeline
+    Iterate it for Segments and close it (or use it in a with block) when done.
+    Raises SourceUnavailable when the pipeline gave up, or when no segment
+    came for Pipeline.WAIT_TIMEOUT seconds.
+    """
+    def __init__(self, pipeline, audio=False):
+        self.pipeline = pipeline
+        self.audio = audio
+        self.position = pipeline.sequence - len(pipeline.segments)
+        self.closed = False
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        pipeline = self.pipeline
+        deadline = time.time() + pipeline.WAIT_TIMEOUT
+        with pipeline._condition:
+            while pipeline.running and not self.closed and self.position >= pipeline.sequence:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SourceUnavailable('Nothing from {} for {} s'.format(
+                        pipeline.key, pipeline.WAIT_TIMEOUT))
+                pipeline._condition.wait(remaining)
+            if not self.closed and not pipeline.running and pipeline.error:
+                raise SourceUnavailable(pipeline.error)
+            if self.closed or not pipeline.running:
+                raise StopIteration
+            oldest = pipeline.sequence - len(pipeline.segments)
+            if self.position < oldest:
+                logging.info('Listener behind on %s, skipping %d segments',
+                    pipeline.key, oldest - self.position, extra={'channel': pipeline.key})
+                self.position = oldest
+            segment = pipeline.segments[self.position - oldest]
+        self.position += 1
+        return segment
+
+
+    @property
+    def lag(self):
+        """How many published segments this listener has yet to get"""
+        return self.pipeline.sequence - self.position
+
+
+    def skip(self):
+        """Jumps ahead to the newest segment"""
+        with self.pipeline._condition:
+            self.position = max(self.position, self.pipeline.sequence - 1)
+
+
+    def close(self):
+        with self.pipeline._registry.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.pipeline.listeners -= 1
+            if self.audio:
+                self.pipeline.audio_listeners -= 1
+            if not self.pipeline.listeners:
+                self.pipeline.idle_since = time.time()
+
+
+class PrivateStream():
+    """
+    A source that belongs to a single listener, used like a Subscription
+    There is nothing to skip ahead to, its lag is always 0. Any failure of
+    the source is raised as SourceUnavailable.
+    """
+    lag = 0
+
+
+    def __init__(self, segments):
+        self._segments = segments
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        try:
+            return next(self._segments)
+        except (StopIteration, SourceUnavailable):
+            raise
+        except Exception as e:
+            logging.exception('Private stream source failed')
+            raise SourceUnavailable(str(e))
+
+
+    def skip(self):
+        pass
+
+
+    def close(self):
+        self._segments.close()
+
+
+class Registry():
+    """
+    Keeps one running Pipeline per key, started on first use and stopped
+    once it has had no listeners for Pipeline.IDLE_TIMEOUT seconds
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pipelines = {}
+
+
+    def subscribe(self, key, source, audio=False):
+        """
+        Returns a new Subscription to the pipeline for key, starting it if
+        needed. Audio says whether this listener wants demuxed audio.
+        """
+        with self.lock:
+            pipeline = self.pipelines.get(key)
+            started = pipeline is not None
+            if not started:
+                pipeline = Pipeline(self, key, source)
+                self.pipelines[key] = pipeline
+            pipeline.listeners += 1
+            if audio:
+                pipeline.audio_listeners += 1
+            with pipeline._condition:
+                subscription = Subscription(pipeline, audio)
+            if not started:
+                # counted first, so the source sees whether audio is wanted
+                pipeline.start()
+            return subscription
+
+
+    def get(self, key):
+        """Returns the running pipeline for key, or None"""
+        with self.lock:
+            return self.pipelines.get(key)
+
+
+    def release_if_idle(self, pipeline):
+        """Stops and forgets a pipeline that nobody has listened to for a while"""
+        with self.lock:
+            if pipeline.listeners or time.time() - pipeline.idle_since < Pipeline.IDLE_TIMEOUT:
+                return False
+            self._remove(pipeline)
+            return True
+
+
+    def stop(self, pipeline):
+        """Stops and forgets a pipeline whatever its listeners"""
+        with self.lock:
+            self._remove(pipeline)
+
+
+    def _remove(self, pipeline):
+        if self.pipelines.get(pipeline.key) is pipeline:
+            del self.pipelines[pipeline.key]
+        pipeline.running = False
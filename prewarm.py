@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import logging
+import json
+import time
+import os
+
+import multiprocessing
+
+import shared
+
+
+class Prewarmer():
+    """
+    Keeps the channels listeners are likely to tune in to running ahead of time
+
+    Tune-ins are counted per channel and hour of the day. Every INTERVAL
+    seconds the channels with the most tune-ins for this hour and the next
+    are warmed by holding a subscription to their pipeline, which keeps their
+    token, playlist and newest segments fresh, so a listener arriving gets
+    audio straight from the backlog. No more channels are warmed than fit in
+    the bandwidth budget.
+
+    With pre-forked workers only one of them warms channels, but hits and
+    misses are counted by all of them and the warm list is kept in shared
+    memory, so status() reports for the whole server whichever answers.
+    """
+    INTERVAL = 60
+    DAILY_DECAY = 0.9
+
+
+    def __init__(self, stream, is_warm, lineup, top=0, bandwidth=0,
+            channel_bandwidth=64, stats_file=None, workers=1):
+        self.stream = stream
+        self.is_warm = is_warm
+        self.lineup = lineup
+        self.top = top
+        self.bandwidth = bandwidth
+        self.channel_bandwidth = channel_bandwidth
+        self.stats_file = stats_file
+        self.counts = collections.defaultdict(lambda: [0.0] * 24)
+        self.hits = shared.WorkerCounts(workers)
+        self.misses = shared.WorkerCounts(workers)
+        self.warm = {}
+        self.warm_channels = multiprocessing.get_context('fork').Array('i', [-1] * top, lock=False)
+        self._day = time.localtime().tm_yday
+        self._lock = threading.Lock()
+
+        self._load()
+
+
+    def start(self):
+        """Starts warming, nothing runs or is saved while prewarming is off"""
+        if not self.top:
+            return
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+
+    def _load(self):
+        if not self.stats_file or not os.path.isfile(self.stats_file):
+            return
+        try:
+            with open(self.stats_file) as f:
+                for channel_number, counts in json.load(f).items():
+                    self.counts[int(channel_number)] = counts
+        except (OSError, ValueError) as e:
+            logging.warning('Could not load tune-in stats from %s: %s', self.stats_file, e)
+
+
+    def _save(self):
+        if not self.stats_file:
+            return
+        with self._lock:
+            data = json.dumps(self.counts)
+        temporary = self.stats_file + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(data)
+        os.replace(temporary, self.stats_file)
+
+
+    def tune_in(self, channel_number, bitrate=None):
+        """Counts a live tune-in, and whether the channel was already warm"""
+        hour = time.localtime().tm_hour
+        warm = self.is_warm(self.lineup[channel_number], bitrate)
+        with self._lock:
+            self.counts[channel_number][hour] += 1
+            if warm:
+                self.hits.add()
+            else:
+                self.misses.add()
+        return warm
+
+
+    def wanted(self):
+        """Channel numbers to keep warm right now, best first"""
+        limit = self.top
+        if self.bandwidth:
+            limit = min(limit, int(self.bandwidth // self.channel_bandwidth))
+        hour = time.localtime().tm_hour
+        with self._lock:
+            scores = {channel_number: counts[hour] + counts[(hour + 1) % 24]
+                for channel_number, counts in self.counts.items()}
+        ranked = sorted((x for x in scores if scores[x] > 0 and x in self.lineup),
+            key=lambda x: -scores[x])
+        return ranked[:limit]
+
+
+    def _decay(self):
+        day = time.localtime().tm_yday
+        if day == self._day:
+            return
+        self._day = day
+        with self._lock:
+            for counts in self.counts.values():
+                counts[:] = [x * self.DAILY_DECAY for x in counts]
+
+
+    def _run(self):
+        while True:
+            time.sleep(self.INTERVAL)
+            try:
+                self._decay()
+                wanted = set(self.wanted())
+                with self._lock:
+                    cooling = [x for x in self.warm if x not in wanted]
+                    starting = [x for x in wanted if x not in self.warm]
+                    subscriptions = [self.warm.pop(x) for x in cooling]
+                for channel_number, subscription in zip(cooling, subscriptions):
+                    logging.info('Prewarm: letting channel #%s cool down', channel_number)
+                    subscription.close()
+                for channel_number in starting:
+                    logging.info('Prewarm: warming channel #%s', channel_number)
+                    subscription = self.stream(self.lineup[channel_number])
+                    with self._lock:
+                        self.warm[channel_number] = subscription
+                with self._lock:
+                    channels = sorted(self.warm)
+                    self.warm_channels[:] = channels + [-1] * (self.top - len(channels))
+                self._save()
+            except Exception:
+                logging.exception('Prewarm pass failed')
+
+
+    def status(self):
+        hits, misses = self.hits.total(), self.misses.total()
+        tune_ins = hits + misses
+        return {
+            'warm': [x for x in self.warm_channels if x >= 0],
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / tune_ins if tune_ins else None,
+        }
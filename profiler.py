@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import tracemalloc
+import sys
+import time
+
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def sample(duration, interval=0.005):
+    '''
+    Sample the stacks of every other thread for duration seconds
+
+    Returns collapsed stacks, one "frame;frame;frame count" line per distinct
+    stack, as consumed by flamegraph.pl and speedscope. Nothing is hooked into
+    the interpreter, so the server runs at full speed except while sampling.
+    '''
+    if not _lock.acquire(blocking=False):
+        raise RuntimeError('A profile is already running')
+    try:
+        me = threading.get_ident()
+        stacks = collections.Counter()
+        end = time.time() + duration
+        while time.time() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+    finally:
+        _lock.release()
+
+    return '\n'.join('{} {}'.format(stack, count)
+                     for stack, count in stacks.most_common()) + '\n'
+
+
+def memory_start(frames=1):
+    '''Start tracing allocations, they are only traced while this is on'''
+    global _snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    _snapshot = tracemalloc.take_snapshot()
+
+
+def memory_stop():
+    global _snapshot
+    tracemalloc.stop()
+    _snapshot = None
+
+
+def memory_diff(limit=50):
+    '''
+    Top allocation sites by growth since the last call (or memory_start)
+    Returns a plain text report
+    '''
+    global _snapshot
+    if not tracemalloc.is_tracing():
+        raise RuntimeError('Memory tracing is off')
+    snapshot = tracemalloc.take_snapshot()
+    stats = snapshot.compare_to(_snapshot, 'lineno')
+    _snapshot = snapshot
+
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ['traced: {} b, peak: {} b'.format(current, peak)]
+    lines.extend(str(stat) for stat in stats[:limit])
+    return '\n'.join(lines) + '\n'
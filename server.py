@@ -9,14 +9,26 @@ import mimetypes
 import json
 import sys
 import logging
-import collections
 import time
 import math
+import signal
+import hmac
+import urllib.parse
 
 import jinja2
+import requests
 
 import sirius
-import mpegutils
+import pipeline
+import cluster
+import accounts
+import profiler
+import logutils
+import admission
+import prewarm
+import audiobus
+import history
+import shared
 
 
 class Singleton(type):
@@ -28,37 +40,337 @@ class Singleton(type):
 
 
 class SeriousBackend(metaclass=Singleton):
-    def __init__(self):
-        self._cfg = configuration.configuration()
-        self.sxm = sirius.Sirius()
-        self.templates = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'), autoescape=True)
+    # seconds a looked up bitrate tier of a channel is trusted
+    TIER_CACHE = 3600
 
-        username = self.config('username')
-        password = self.config('password')
-        logging.info('Signing in with username "{}"'.format(username))
-        self.sxm.login(username, password)
 
-
-    def config(self, key):
-        return self._cfg.get('SeriousCast', key)
+    def __init__(self, cfg=None):
+        self._cfg = cfg or configuration.configuration()
+        self.sxm = sirius.Sirius()
+        self.templates = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'), autoescape=True)
+        self.pipelines = pipeline.Registry()
+        self.tiers = {}
+        # shared by pre-forked workers, so they are created before forking
+        self.workers = int(self.config('workers', '1'))
+        self.fetching = shared.WorkerCounts(self.workers)
+        self.bitrate = self.config('bitrate', sirius.Sirius.DEFAULT_BITRATE)
+        if self.bitrate not in sirius.Sirius.BITRATES:
+            raise ValueError('bitrate must be one of {}'.format(', '.join(sirius.Sirius.BITRATES)))
+
+        node = self.config('cluster_node', '{}:{}'.format(self.config('hostname'), self.config('port')))
+        nodes = [x.strip() for x in self.config('cluster_nodes', '').split(',') if x.strip()]
+        self.cluster = cluster.Cluster(node, nodes)
+
+        self.accounts = accounts.AccountPool(self.sxm, configuration.accounts(self._cfg))
+
+        self.admission = admission.Admission(self.upstream_load,
+            max_listeners=int(self.config('max_listeners', '0')),
+            max_channel_listeners=int(self.config('max_channel_listeners', '0')),
+            max_load=float(self.config('max_load', '0')),
+            max_upstream=int(self.config('max_upstream', '0')),
+            retry_after=int(self.config('retry_after', '10')),
+            send_timeout=float(self.config('send_timeout', '30')),
+            max_send_backlog=int(self.config('max_send_backlog', '2097152')),
+            max_lag=int(self.config('max_lag', '0')),
+            slow_listeners=self.config('slow_listeners', 'skip'),
+            workers=self.workers)
+
+        self.prewarmer = prewarm.Prewarmer(self.stream, self.is_warm, self.sxm.lineup,
+            top=int(self.config('prewarm_top', '0')),
+            bandwidth=float(self.config('prewarm_bandwidth', '0')),
+            channel_bandwidth=int(self.bitrate[:-1]),
+            stats_file=self.config('prewarm_stats', 'tune-ins.json'),
+            workers=self.workers)
+
+        self.history = history.History(self.config('history_dir', 'history'),
+            retention=float(self.config('history_days', '7')) * 86400)
+
+        # set per worker process when pre-forking, see serve_workers
+        self.bus = None
+        self.worker = 0
+
+
+    def start(self):
+        """Starts background threads, in each worker process when pre-forking"""
+        shared.claim(self.worker)
+        self.cluster.start()
+        if self.bus is not None:
+            self.bus.start()
+        if self.worker == 0:
+            # tune-ins are spread evenly over workers, one of them is a fair sample
+            self.prewarmer.start()
+            # one process expiring history is enough, they share the files
+            self.history.start()
+
+
+    def config(self, key, default=None):
+        if default is None:
+            return self._cfg.get('SeriousCast', key)
+        return self._cfg.get('SeriousCast', key, fallback=default)
+
+
+    def upstream(self, channel_key, rewind=0, bitrate=sirius.Sirius.DEFAULT_BITRATE):
+        """
+        Generator of Segments fetched from SiriusXM
+        A live fetch ends once another cluster node owns the channel, so the
+        pipeline restarts its source and pulls from the new owner instead
+        """
+        load_key = '{}/{}'.format(channel_key, bitrate)
+        account = self.accounts.acquire(load_key)
+        self.fetching.add()
+        try:
+            for name, data in account.sxm.segment_generator(channel_key, rewind, bitrate):
+                account.segments += 1
+                yield pipeline.Segment(name, data)
+                if not rewind and not self.cluster.is_owner(channel_key):
+                    logging.info('Channel {} moved to {}, handing over'.format(
+                        channel_key, self.cluster.owner(channel_key)))
+                    return
+        except sirius.SiriusNotFoundException as e:
+            # missing segments are skipped, so it was the playlist: no such tier
+            self.tiers[(channel_key, bitrate)] = (False, time.time())
+            raise pipeline.SourceUnavailable(str(e))
+        except sirius.SiriusAuthException as e:
+            # the pipeline retries, and the pool hands it a different account.
+            # Anything else (a 404, a network error) is not the account's fault
+            self.accounts.fail(account, e)
+            raise
+        finally:
+            self.fetching.add(-1)
+            self.accounts.release(account, load_key)
+
+
+    def upstream_load(self):
+        """Channels fetched from SiriusXM by all workers, and accounts this one can use"""
+        channels, available = self.accounts.load()
+        return self.fetching.total(), available
+
+
+    def source(self, channel, rewind=0, bitrate=None, wants_audio=lambda: False):
+        """
+        Segments for a channel, from upstream or from its owner in a cluster
+        When pre-forking, live tiers owned by another worker come off the audio
+        bus, and those owned by this worker are published to it. Track changes
+        are recorded wherever a live tier is not read off the bus. While
+        wants_audio() is true, segments from another worker or node are asked
+        for with their audio demuxed.
+        """
+        channel_key = str(channel['channelKey'])
+        bitrate = bitrate or self.bitrate
+        bus_key = '{}/{}'.format(channel_key, bitrate)
+        if self.bus is not None and not rewind and not self.bus.is_owner(bus_key):
+            return self.bus.read(bus_key, int(channel['siriusChannelNo']), bitrate, wants_audio)
+
+        owner = self.cluster.owner(channel_key)
+        if owner == self.cluster.node:
+            segments = self.upstream(channel_key, rewind, bitrate)
+        else:
+            segments = self.cluster.feed(owner, channel['siriusChannelNo'], rewind, bitrate,
+                wants_audio)
+        if not rewind:
+            segments = self.history.recording(int(channel['siriusChannelNo']), segments)
+        if self.bus is not None and not rewind:
+            segments = self.bus.publish(bus_key, segments, wants_audio)
+        return segments
+
+
+    def pin(self, channel_number, bitrate, audio=False):
+        """Keeps a live channel tier running until the returned subscription is closed"""
+        return self.stream(self.sxm.lineup[channel_number], 0, bitrate, audio)
+
+
+    def live(self, channel, bitrate=None):
+        """The running pipeline for a channel's bitrate tier, or None"""
+        return self.pipelines.get('{}/{}'.format(channel['channelKey'], bitrate or self.bitrate))
+
+
+    def needs_upstream(self, channel, rewind=0, bitrate=None):
+        """Whether listening would start a new fetch from SiriusXM in this process"""
+        bus_key = '{}/{}'.format(channel['channelKey'], bitrate or self.bitrate)
+        if self.bus is not None and not rewind and not self.bus.is_owner(bus_key):
+            return False
+        if not self.cluster.is_owner(str(channel['channelKey'])):
+            return False
+        return bool(rewind) or self.live(channel, bitrate) is None
+
+
+    def is_warm(self, channel, bitrate=None):
+        """Whether a live listener would get audio from an existing backlog"""
+        live = self.live(channel, bitrate)
+        return live is not None and len(live.segments) > 0
+
+
+    def has_bitrate(self, channel, bitrate):
+        """
+        Whether upstream offers a channel at a bitrate tier
+        Tiers other than the default are looked up with one playlist request
+        the first time, and the answer is kept for TIER_CACHE seconds
+        """
+        channel_key = str(channel['channelKey'])
+        known = self.tiers.get((channel_key, bitrate))
+        if known is not None and time.time() - known[1] < self.TIER_CACHE:
+            return known[0]
+        if bitrate == self.bitrate or self.live(channel, bitrate) is not None:
+            return True
+
+        load_key = '{}/{}'.format(channel_key, bitrate)
+        try:
+            account = self.accounts.acquire(load_key)
+        except (sirius.SiriusException, requests.RequestException):
+            # no account to ask with, the pipeline will find out
+            return True
+        try:
+            account.sxm.get_playlist(channel_key, bitrate)
+            available = True
+        except sirius.SiriusNotFoundException:
+            available = False
+        except sirius.SiriusAuthException as e:
+            self.accounts.fail(account, e)
+            return True
+        except (sirius.SiriusException, requests.RequestException) as e:
+            logging.warning('Could not look up {} of channel {}: {}'.format(bitrate, channel_key, e))
+            return True
+        finally:
+            self.accounts.release(account, load_key)
+
+        if not available:
+            logging.info('Channel {} is not offered at {}'.format(channel_key, bitrate))
+        self.tiers[(channel_key, bitrate)] = (available, time.time())
+        return available
+
+
+    def choose_bitrate(self, channel, requested=None, rewind=0):
+        """
+        The bitrate tier to serve: the one requested (or the default), unless
+        that would need another upstream fetch while upstream is saturated and
+        another tier of the channel is already running
+        """
+        bitrate = requested or self.bitrate
+        if rewind or not self.needs_upstream(channel, 0, bitrate):
+            return bitrate
+        if self.admission.upstream_saturated() is None:
+            return bitrate
+        for other in sirius.Sirius.BITRATES:
+            if self.live(channel, other) is not None:
+                logging.info('Upstream saturated, serving %s instead of %s', other, bitrate)
+                return other
+        return bitrate
+
+
+    def stream(self, channel, rewind=0, bitrate=None, audio=False):
+        """
+        Returns a closable iterator of Segments for a channel
+        Live listeners of a bitrate tier share one pipeline, rewound ones get
+        their own source. Audio says whether the listener wants demuxed audio
+        rather than only the TS.
+        """
+        bitrate = bitrate or self.bitrate
+        if rewind:
+            return pipeline.PrivateStream(self.source(channel, rewind, bitrate, lambda: audio))
+        return self.pipelines.subscribe('{}/{}'.format(channel['channelKey'], bitrate),
+            lambda wants_audio: self.source(channel, 0, bitrate, wants_audio), audio)
 
 
 class SeriousHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     daemon_threads = True
 
 
+def serve_workers(sbe, port, count):
+    """
+    Pre-forks count worker processes that all accept on port
+    The backend is set up (and signed in) once, before forking
+    """
+    inboxes = audiobus.inboxes(count)
+    children = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid:
+            children[pid] = index
+            return
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            logutils.after_fork()
+            sbe.worker = index
+            sbe.bus = audiobus.AudioBus(index, count, port, inboxes, sbe.pin)
+            sbe.start()
+            logging.info('Worker {} serving on port {}'.format(index, port))
+            server = SeriousHTTPServer(('0.0.0.0', port), SeriousRequestHandler, bind_and_activate=False)
+            # every worker listens on the same port, the kernel spreads connections
+            server.allow_reuse_port = True
+            server.server_bind()
+            server.server_activate()
+            server.serve_forever()
+        finally:
+            logging.shutdown()
+            os._exit(1)
+
+    audiobus.cleanup(port)
+    for index in range(count):
+        spawn(index)
+    # a plain kill stops the workers and removes the rings too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            pid, status = os.wait()
+            index = children.pop(pid, None)
+            if index is not None:
+                logging.warning('Worker {} exited with status {}, restarting'.format(index, status))
+                time.sleep(1)
+                spawn(index)
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        audiobus.cleanup(port)
+
+
 class SeriousRequestHandler(http.server.BaseHTTPRequestHandler):
+    # persistent connections for everything but the streams, which close
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = tuple((re.compile(route_path), route_handler) for route_path, route_handler in (
+        (r'^/$', 'index'),
+        (r'^/static/(?P<path>.+)$', 'static_file'),
+        (r'^/channel/(?P<channel_number>[0-9]+)$', 'channel_stream'),
+        (r'^/channel/(?P<channel_number>[0-9]+)/(?P<rewind>[0-9]+)$', 'channel_stream'),
+        (r'^/channel/(?P<channel_number>[0-9]+)\.ts$', 'channel_transport_stream'),
+        (r'^/channel/(?P<channel_number>[0-9]+)/(?P<rewind>[0-9]+)\.ts$', 'channel_transport_stream'),
+        (r'^/metadata/(?P<channel_number>[0-9]+)$', 'channel_metadata'),
+        (r'^/metadata/(?P<channel_number>[0-9]+)/(?P<rewind>[0-9]+)$', 'channel_metadata'),
+        (r'^/history/(?P<channel_number>[0-9]+)$', 'channel_history'),
+        (r'^/accounts$', 'account_status'),
+        (r'^/prewarm$', 'prewarm_status'),
+        (r'^/cluster/ping$', 'cluster_ping'),
+        (r'^/cluster/feed/(?P<channel_number>[0-9]+)$', 'cluster_feed'),
+        (r'^/cluster/feed/(?P<channel_number>[0-9]+)/(?P<rewind>[0-9]+)$', 'cluster_feed'),
+        (r'^/admin/profile$', 'admin_profile'),
+        (r'^/admin/memory/(?P<action>start|stop|diff)$', 'admin_memory'),
+    ))
+
+
     def __init__(self, *args, **kwargs):
         self.sbe = SeriousBackend()
+        self.ticket = None
+        # idle keep-alive connections give their thread back after this long
+        self.timeout = float(self.sbe.config('keepalive_timeout', '15')) or None
         super().__init__(*args, **kwargs)
 
 
+    def finish(self):
+        if self.ticket is not None:
+            self.ticket.release()
+        super().finish()
+
+
     def send_standard_headers(self, content_length, headers=None, response_code=200):
-        logging.debug('HTTP {} [{}] ({} b)'.format(response_code, self.path, content_length))
+        # the query string may carry the admin token, keep it out of the log
+        logging.debug('HTTP %s [%s] (%s b)', response_code, self.path.partition('?')[0], content_length)
 
-        self.protocol_version = 'HTTP/1.1'
         self.send_response_only(response_code)
-        self.send_header('Connection', 'close')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Connection', 'keep-alive')
         self.send_header('Content-length', content_length)
 
         if headers != None:
@@ -68,6 +380,76 @@ class SeriousRequestHandler(http.server.BaseHTTPRequestHandler):
         self.end_headers()
 
 
+    def service_unavailable(self, reason):
+        response = (str(reason) + '\n').encode('utf-8')
+
+        self.send_standard_headers(len(response), {
+            'Content-type': 'text/plain; charset=utf-8',
+            'Retry-After': str(self.sbe.admission.retry_after),
+        }, response_code=503)
+
+        self.write_body(response)
+
+
+    def requested_bitrate(self):
+        """
+        The ?br= bitrate tier asked for, as in Sirius.BITRATES, or None
+        Accepts both 96 and 96k, raises ValueError for tiers that don't exist
+        """
+        bitrate = self.query.get('br', [''])[0].lower()
+        if not bitrate:
+            return None
+        if not bitrate.endswith('k'):
+            bitrate += 'k'
+        if bitrate not in sirius.Sirius.BITRATES:
+            raise ValueError('br must be one of {}'.format(', '.join(sirius.Sirius.BITRATES)))
+        return bitrate
+
+
+    def bad_request(self, reason):
+        response = (str(reason) + '\n').encode('utf-8')
+
+        self.send_standard_headers(len(response), {
+            'Content-type': 'text/plain; charset=utf-8',
+        }, response_code=400)
+
+        self.write_body(response)
+
+
+    def admit(self, channel, rewind=0, bitrate=None):
+        """
+        Takes a listener place for this connection, released in finish()
+        Returns False after refusing the listener
+        """
+        try:
+            self.ticket = self.sbe.admission.enter(str(channel['channelKey']),
+                self.sbe.needs_upstream(channel, rewind, bitrate))
+        except admission.Refused as e:
+            self.service_unavailable(e)
+            return False
+        return True
+
+
+    def slow_listener(self, segments, session):
+        """
+        Deals with a listener that has fallen behind, returns True to evict
+        Otherwise it is skipped ahead to the newest segment
+        """
+        if self.sbe.admission.slow_listeners == 'evict':
+            logging.info('Evicting slow listener %s', self.client_address[0])
+            session.reason = 'evicted'
+            return True
+        logging.info('Skipping slow listener %s ahead', self.client_address[0])
+        session.skips += 1
+        segments.skip()
+        return False
+
+
+    def write_body(self, body):
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
     def index(self):
         template = self.sbe.templates.get_template('list.html')
         channels = sorted(self.sbe.sxm.lineup.values(), key=lambda k: k['siriusChannelNo'])
@@ -82,7 +464,7 @@ class SeriousRequestHandler(http.server.BaseHTTPRequestHandler):
             'Content-type': 'text/html; charset=utf-8',
         })
 
-        self.wfile.write(response)
+        self.write_body(response)
 
 
     def file_not_found(self):
@@ -94,7 +476,7 @@ class SeriousRequestHandler(http.server.BaseHTTPRequestHandler):
             'Content-type': 'text/html; charset=utf-8',
         }, response_code=404)
 
-        self.wfile.write(response)
+        self.write_body(response)
 
 
     def static_file(self, path):
@@ -114,7 +496,7 @@ class SeriousRequestHandler(http.server.BaseHTTPRequestHandler):
                 self.send_standard_headers(len(content), {
                     'Content-type': content_type,
                 })
-                self.wfile.write(content)
+                self.write_body(content)
         else:
             self.file_not_found()
 
@@ -128,67 +510,162 @@ class SeriousRequestHandler(http.server.BaseHTTPRequestHandler):
 
         channel = self.sbe.sxm.lineup[channel_number]
         url = 'http://{}:{}/'.format(self.sbe.config('hostname'), self.sbe.config('port'))
-
-        logging.info('Streaming: Channel #{} "{}" with rewind {}'.format(
+        try:
+            bitrate = self.sbe.choose_bitrate(channel, self.requested_bitrate(), rewind)
+        except ValueError as e:
+            return self.bad_request(e)
+        if not self.sbe.has_bitrate(channel, bitrate):
+            return self.bad_request('Channel #{} is not offered at {}'.format(channel_number, bitrate))
+        if not self.admit(channel, rewind, bitrate):
+            return
+
+        logging.info('Streaming: Channel #{} "{}" at {} with rewind {}'.format(
             channel_number,
             channel['name'],
+            bitrate,
             rewind))
 
         self.protocol_version = 'ICY' # if we don't pretend to be shoutcast, doctors HATE us
+        self.close_connection = True
         self.send_response_only(200)
         self.send_header('Content-type', 'audio/aacp')
-        self.send_header('icy-br', '64')
+        self.send_header('icy-br', bitrate[:-1])
         self.send_header('icy-name', channel['name'])
         self.send_header('icy-genre', channel['genre'])
         self.send_header('icy-url', url)
         self.send_header('icy-metaint', '32768')
         self.end_headers()
+        if self.command == 'HEAD':
+            return
+        if not rewind:
+            self.sbe.prewarmer.tune_in(channel_number, bitrate)
+        self.connection.settimeout(self.sbe.admission.send_timeout)
 
-        channel_id = str(channel['channelKey'])
         track_title = ''
         start_time = None
+        # seconds of audio in one metadata interval at this tier
+        interval = 32768 * 8 / (int(bitrate[:-1]) * 1000)
         new_meta = False
+        log_extra = {'channel': channel_number}
 
         audio = bytearray()
-        for ts_packet in self.sbe.sxm.packet_generator(channel_id, rewind):
-            pes_streams = collections.defaultdict(bytearray)
-            for pes_packet in mpegutils.parse_transport_stream(ts_packet):
-                if 'payload' in pes_packet:
-                    pes_streams[pes_packet['pid']].extend(pes_packet['payload'])
-
-            for pid, pes_stream in pes_streams.items():
-                for es_packet in mpegutils.parse_packetized_elementary_stream(pes_stream):
-                    if pid == 768:
-                        audio.extend(es_packet['payload'])
-                    elif pid == 1024:
-                        metadata = mpegutils.parse_sxm_metadata(es_packet['payload'])
-                        if metadata:
-                            new_title = '{} - {}'.format(metadata[1], metadata[0])
-                            if new_title != track_title:
-                                logging.info("Now playing: " + new_title)
-                                track_title = new_title
-                                new_meta = True
-
-                    if len(audio) >= 32768:
+        try:
+            with logutils.ListenerSession('icy', channel_number, self.client_address[0]) as session, \
+                    self.sbe.stream(channel, rewind, bitrate, audio=True) as segments:
+                for segment in segments:
+                    audio.extend(segment.audio)
+                    if segment.metadata:
+                        new_title = '{} - {}'.format(segment.metadata[1], segment.metadata[0])
+                        if new_title != track_title:
+                            logging.info('Now playing: %s', new_title, extra=log_extra)
+                            track_title = new_title
+                            new_meta = True
+
+                    # a rewound stream is the listener's own, nothing to skip ahead to
+                    # and nobody else to hold up, so only the send timeout applies
+                    if not rewind and len(audio) >= 32768 and self.sbe.admission.behind(self.connection, segments):
+                        if self.slow_listener(segments, session):
+                            return
+                        # drop whole intervals only, so the metadata framing stays intact
+                        del audio[:len(audio) - len(audio) % 32768]
+                        continue
+
+                    while len(audio) >= 32768:
                         if new_meta:
                             meta_title = ("StreamTitle='" + track_title.replace("'", '') + "';").encode('utf-8')
                             meta_length = math.ceil(len(meta_title) / 16)
                             meta_buffer = bytes((meta_length,)) + meta_title + (b'\x00' * ((meta_length * 16) - len(meta_title)))
                             new_meta = False
-                            logging.debug('Metadata: ' + repr(meta_buffer))
+                            logging.debug('Metadata: %r', meta_buffer, extra=log_extra)
                         else:
                             meta_buffer = b'\x00'
                         audio_interval = audio[:32768]
                         del audio[:32768]
                         try:
-                            self.wfile.write(audio_interval)
-                            self.wfile.write(meta_buffer)
-                            if start_time != None and time.time() - start_time < 4:
-                                time.sleep(4 - (time.time() - start_time))
+                            session.write(self.wfile.write, audio_interval)
+                            session.write(self.wfile.write, meta_buffer)
+                            if start_time != None and time.time() - start_time < interval:
+                                time.sleep(interval - (time.time() - start_time))
                             start_time = time.time()
-                        except (ConnectionResetError, ConnectionAbortedError) as e:
-                            logging.info('Connection dropped: ' + str(e))
+                        except TimeoutError:
+                            logging.info('Evicting stalled listener %s', self.client_address[0])
+                            session.reason = 'timeout'
                             return
+                        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
+                            logging.info('Connection dropped: %s', e)
+                            session.reason = 'dropped'
+                            return
+        except pipeline.SourceUnavailable as e:
+            # the headers are out, all that is left is to hang up
+            logging.warning('Channel #{} unavailable, ending stream: {}'.format(channel_number, e))
+
+
+    def channel_transport_stream(self, channel_number, rewind=0):
+        """
+        Passes the decrypted MPEG-TS segments straight through, no demuxing
+        Now playing data is available from /metadata/<channel_number>
+        """
+        channel_number = int(channel_number)
+        rewind = int(rewind)
+
+        if channel_number not in self.sbe.sxm.lineup:
+            return self.file_not_found()
+
+        channel = self.sbe.sxm.lineup[channel_number]
+        try:
+            bitrate = self.sbe.choose_bitrate(channel, self.requested_bitrate(), rewind)
+        except ValueError as e:
+            return self.bad_request(e)
+        if not self.sbe.has_bitrate(channel, bitrate):
+            return self.bad_request('Channel #{} is not offered at {}'.format(channel_number, bitrate))
+        if not self.admit(channel, rewind, bitrate):
+            return
+
+        logging.info('Streaming TS: Channel #{} "{}" at {} with rewind {}'.format(
+            channel_number,
+            channel['name'],
+            bitrate,
+            rewind))
+
+        self.protocol_version = 'HTTP/1.0'
+        self.close_connection = True
+        self.send_response_only(200)
+        self.send_header('Content-type', 'video/MP2T')
+        self.send_header('Connection', 'close')
+        self.send_header('X-Metadata-URL', '/metadata/{}'.format(channel_number))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        if not rewind:
+            self.sbe.prewarmer.tune_in(channel_number, bitrate)
+        self.connection.settimeout(self.sbe.admission.send_timeout)
+
+        try:
+            with logutils.ListenerSession('ts', channel_number, self.client_address[0]) as session, \
+                    self.sbe.stream(channel, rewind, bitrate) as segments:
+                for segment in segments:
+                    if not rewind and self.sbe.admission.behind(self.connection, segments):
+                        if self.slow_listener(segments, session):
+                            return
+                        continue
+                    try:
+                        if rewind:
+                            # rewound segments are ours alone, spooling them gains nothing
+                            session.write(self.wfile.write, segment.data)
+                        else:
+                            with segment.open() as f:
+                                session.write(self.connection.sendfile, f)
+                    except TimeoutError:
+                        logging.info('Evicting stalled listener %s', self.client_address[0])
+                        session.reason = 'timeout'
+                        return
+                    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
+                        logging.info('Connection dropped: %s', e)
+                        session.reason = 'dropped'
+                        return
+        except pipeline.SourceUnavailable as e:
+            # the headers are out, all that is left is to hang up
+            logging.warning('Channel #{} unavailable, ending stream: {}'.format(channel_number, e))
 
 
     def channel_metadata(self, channel_number, rewind=0):
@@ -199,73 +676,284 @@ class SeriousRequestHandler(http.server.BaseHTTPRequestHandler):
             return self.file_not_found()
 
         channel = self.sbe.sxm.lineup[channel_number]
-        channel_id = str(channel['channelKey'])
-        packet = next(self.sbe.sxm.packet_generator(channel_id, rewind))
         metadata = None
 
-        for pes_packet in mpegutils.parse_transport_stream(packet):
-            if pes_packet['pid'] == 1024:
-                for es_packet in mpegutils.parse_packetized_elementary_stream(pes_packet['payload']):
-                    new_meta = mpegutils.parse_sxm_metadata(es_packet['payload'])
-                    if not metadata and new_meta:
-                        metadata = new_meta
-
-        response = json.dumps({
-            'channel': channel,
-            'nowplaying': {
+        # any running tier will do, they all carry the same metadata
+        live = [self.sbe.live(channel, x) for x in sirius.Sirius.BITRATES]
+        live = [x for x in live if x is not None and x.metadata]
+        if not rewind and live:
+            metadata = live[0].metadata
+        else:
+            try:
+                with self.sbe.stream(channel, rewind) as segments:
+                    segment = next(iter(segments), None)
+            except pipeline.SourceUnavailable as e:
+                return self.service_unavailable(e)
+            if segment is None:
+                return self.service_unavailable('Channel #{} stopped'.format(channel_number))
+            metadata = segment.metadata
+
+        nowplaying = None
+        if metadata:
+            nowplaying = {
                 'artist': metadata[1],
                 'title': metadata[0],
                 'album': metadata[2],
-            },
+            }
+        response = json.dumps({
+            'channel': channel,
+            'nowplaying': nowplaying,
         }, sort_keys=True, indent=4).encode('utf-8')
 
         self.send_standard_headers(len(response), {
             'Content-type': 'application/json',
         })
 
-        self.wfile.write(response)
+        self.write_body(response)
 
 
-    def do_GET(self):
-        routes = (
-            (r'^/$', self.index),
-            (r'^/static/(?P<path>.+)$', self.static_file),
-            (r'^/channel/(?P<channel_number>[0-9]+)$', self.channel_stream),
-            (r'^/channel/(?P<channel_number>[0-9]+)/(?P<rewind>[0-9]+)$', self.channel_stream),
-            (r'^/metadata/(?P<channel_number>[0-9]+)$', self.channel_metadata),
-            (r'^/metadata/(?P<channel_number>[0-9]+)/(?P<rewind>[0-9]+)$', self.channel_metadata),
-        )
-
-        for route_path, route_handler in routes:
-            match = re.search(route_path, self.path)
+    def channel_history(self, channel_number):
+        """Recorded track changes since ?since= (a Unix time, default an hour ago)"""
+        channel_number = int(channel_number)
+
+        if channel_number not in self.sbe.sxm.lineup:
+            return self.file_not_found()
+
+        try:
+            since = float(self.query.get('since', [time.time() - 3600])[0])
+            limit = int(self.query.get('limit', [0])[0])
+        except ValueError as e:
+            return self.bad_request(e)
+        if limit < 0:
+            return self.bad_request('limit must not be negative')
+
+        response = json.dumps({
+            'channel': self.sbe.sxm.lineup[channel_number],
+            'history': self.sbe.history.since(channel_number, since, limit),
+        }, sort_keys=True, indent=4).encode('utf-8')
+
+        self.send_standard_headers(len(response), {
+            'Content-type': 'application/json',
+        })
+
+        self.write_body(response)
+
+
+    def cluster_ping(self):
+        response = json.dumps(self.sbe.cluster.status(), sort_keys=True, indent=4).encode('utf-8')
+
+        self.send_standard_headers(len(response), {
+            'Content-type': 'application/json',
+        })
+
+        self.write_body(response)
+
+
+    def cluster_feed(self, channel_number, rewind=0):
+        """
+        Internal feed for other nodes, see cluster.encode_segment
+        Only served to the configured cluster nodes, as it bypasses admission
+        """
+        if not self.sbe.cluster.is_peer(self.client_address[0]):
+            return self.file_not_found()
+
+        channel_number = int(channel_number)
+        rewind = int(rewind)
+
+        if channel_number not in self.sbe.sxm.lineup:
+            return self.file_not_found()
+
+        channel = self.sbe.sxm.lineup[channel_number]
+        audio = self.query.get('audio', ['0'])[0] == '1'
+        try:
+            bitrate = self.requested_bitrate() or self.sbe.bitrate
+        except ValueError as e:
+            return self.bad_request(e)
+        if not self.sbe.has_bitrate(channel, bitrate):
+            # the asking node stops its pipeline instead of retrying
+            return self.send_standard_headers(0, response_code=404)
+        if not self.sbe.cluster.is_owner(str(channel['channelKey'])):
+            # never proxy a feed, the asking node will retry once we agree on the owner
+            return self.send_standard_headers(0, {
+                'Retry-After': str(cluster.Cluster.CHECK_INTERVAL),
+            }, response_code=503)
+
+        logging.info('Feeding: Channel #{} "{}" to {}'.format(
+            channel_number,
+            channel['name'],
+            self.client_address[0]))
+
+        self.protocol_version = 'HTTP/1.0'
+        self.close_connection = True
+        self.send_response_only(200)
+        self.send_header('Content-type', 'application/octet-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        self.connection.settimeout(self.sbe.admission.send_timeout)
+
+        try:
+            with logutils.ListenerSession('feed', channel_number, self.client_address[0]) as session, \
+                    self.sbe.stream(channel, rewind, bitrate, audio) as segments:
+                for segment in segments:
+                    if not rewind and not self.sbe.cluster.is_owner(str(channel['channelKey'])):
+                        # the asking node retries and finds the new owner
+                        logging.info('Channel #{} moved, ending feed to {}'.format(
+                            channel_number, self.client_address[0]))
+                        session.reason = 'moved'
+                        return
+                    try:
+                        session.write(self.wfile.write, cluster.encode_segment(segment, audio))
+                    except TimeoutError:
+                        logging.info('Evicting stalled feed to %s', self.client_address[0])
+                        session.reason = 'timeout'
+                        return
+                    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
+                        logging.info('Feed dropped: %s', e)
+                        session.reason = 'dropped'
+                        return
+        except pipeline.SourceUnavailable as e:
+            # the headers are out, all that is left is to hang up
+            logging.warning('Channel #{} unavailable, ending feed: {}'.format(channel_number, e))
+
+
+    def prewarm_status(self):
+        response = json.dumps(self.sbe.prewarmer.status(), sort_keys=True, indent=4).encode('utf-8')
+
+        self.send_standard_headers(len(response), {
+            'Content-type': 'application/json',
+        })
+
+        self.write_body(response)
+
+
+    def account_status(self):
+        """Per-account load and errors, an admin route as it names the accounts"""
+        if not self.admin_allowed():
+            return
+        response = json.dumps(self.sbe.accounts.status(), sort_keys=True, indent=4).encode('utf-8')
+
+        self.send_standard_headers(len(response), {
+            'Content-type': 'application/json',
+        })
+
+        self.write_body(response)
+
+
+    def admin_allowed(self):
+        """
+        Admin routes need the admin_token setting, sent as a bearer token or
+        ?token=, and are hidden altogether when no token is configured
+        """
+        token = self.sbe.config('admin_token', '')
+        if not token:
+            self.file_not_found()
+            return False
+        offered = self.headers.get('Authorization', '')
+        if offered.startswith('Bearer '):
+            offered = offered[len('Bearer '):]
+        else:
+            offered = self.query.get('token', [''])[0]
+        if not hmac.compare_digest(offered.encode('utf-8'), token.encode('utf-8')):
+            self.send_standard_headers(0, response_code=403)
+            return False
+        return True
+
+
+    def admin_text(self, text, response_code=200):
+        response = text.encode('utf-8')
+
+        self.send_standard_headers(len(response), {
+            'Content-type': 'text/plain; charset=utf-8',
+        }, response_code=response_code)
+
+        self.write_body(response)
+
+
+    def admin_profile(self):
+        """Samples every thread for ?seconds=N and returns collapsed stacks"""
+        if not self.admin_allowed():
+            return
+        try:
+            seconds = float(self.query.get('seconds', ['10'])[0])
+            interval = float(self.query.get('interval', ['0.005'])[0])
+        except ValueError as e:
+            return self.bad_request(e)
+        # a tiny interval would spin on the GIL and starve the streaming threads
+        seconds = min(max(seconds, 0), 300)
+        interval = max(interval, 0.001)
+        logging.info('Profiling for {} s'.format(seconds))
+        try:
+            self.admin_text(profiler.sample(seconds, interval))
+        except RuntimeError as e:
+            self.admin_text(str(e) + '\n', response_code=409)
+
+
+    def admin_memory(self, action):
+        """Starts or stops tracemalloc, or reports growth since the last diff"""
+        if not self.admin_allowed():
+            return
+        try:
+            frames = max(int(self.query.get('frames', ['1'])[0]), 1)
+            limit = max(int(self.query.get('limit', ['50'])[0]), 1)
+        except ValueError as e:
+            return self.bad_request(e)
+        if action == 'start':
+            profiler.memory_start(frames)
+            self.admin_text('Memory tracing on\n')
+        elif action == 'stop':
+            profiler.memory_stop()
+            self.admin_text('Memory tracing off\n')
+        else:
+            try:
+                self.admin_text(profiler.memory_diff(limit))
+            except RuntimeError as e:
+                self.admin_text(str(e) + '\n', response_code=409)
+
+
+    def route(self):
+        path, _, query = self.path.partition('?')
+        self.query = urllib.parse.parse_qs(query)
+
+        for route_path, route_handler in self.ROUTES:
+            match = route_path.match(path)
             if match:
-                return route_handler(**match.groupdict())
+                return getattr(self, route_handler)(**match.groupdict())
 
         self.file_not_found()
 
 
+    def do_GET(self):
+        self.route()
+
+
+    def do_HEAD(self):
+        # routes send the same headers, write_body and the streams skip the body
+        self.route()
+
+
 if __name__ == '__main__':
-    # Basic logging to file
-    logging.basicConfig(level=logging.DEBUG,
-        format='%(asctime)s :: %(levelname)s :: %(thread)d :: %(message)s',
-        datefmt='%m/%d %H:%M',
-        filename='seriouscast.log',
-        filemode='w')
-
-    # Set up console logging output
-    console = logging.StreamHandler()
-    console.setLevel(logging.INFO)
-    console_format = logging.Formatter('%(levelname)s :: %(thread)-5d :: %(message)s')
-    console.setFormatter(console_format)
-    logging.getLogger('').addHandler(console)
+    # Optional settings file argument, so several nodes can run side by side
+    cfg = configuration.configuration(*sys.argv[1:2])
+
+    # Logging to file and console, written from a background thread
+    logutils.setup(cfg.get('SeriousCast', 'logfile', fallback='seriouscast.log'),
+        burst=cfg.getint('SeriousCast', 'log_burst', fallback=5),
+        interval=cfg.getint('SeriousCast', 'log_interval', fallback=60))
 
     # Disable (most) logging from requests
     requests_log = logging.getLogger("requests")
     requests_log.setLevel(logging.WARNING)
 
     logging.info('Setting up server, please wait')
-    sbe = SeriousBackend()
+    sbe = SeriousBackend(cfg)
     port = int(sbe.config('port'))
-    logging.info('Starting server on port {}'.format(port))
-    server = SeriousHTTPServer(('0.0.0.0', port), SeriousRequestHandler)
-    server.serve_forever()
+    if sbe.workers > 1:
+        logging.info('Starting {} workers on port {}'.format(sbe.workers, port))
+        serve_workers(sbe, port, sbe.workers)
+    else:
+        logging.info('Starting server on port {}'.format(port))
+        sbe.start()
+        server = SeriousHTTPServer(('0.0.0.0', port), SeriousRequestHandler)
+        server.serve_forever()
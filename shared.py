@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+'''
+Counters shared by pre-forked worker processes
+
+A WorkerCounts keeps one slot per worker in shared memory. Each process only
+changes its own slot and reads the sum, so limits hold for the whole server
+and a worker that dies takes nothing with it: its replacement calls claim()
+and starts its slots from zero. Counts must be created before forking.
+'''
+import threading
+
+import multiprocessing
+
+_counts = []
+_worker = 0
+
+
+class WorkerCounts():
+    def __init__(self, workers=1):
+        self._values = multiprocessing.get_context('fork').Array('q', workers, lock=False)
+        self._lock = threading.Lock()
+        _counts.append(self)
+
+
+    def add(self, n=1):
+        with self._lock:
+            self._values[_worker] += n
+
+
+    def total(self):
+        return sum(self._values)
+
+
+def claim(index):
+    '''Makes this process worker index, zeroing what an earlier one left'''
+    global _worker
+    _worker = index
+    for counts in _counts:
+        counts._values[index] = 0
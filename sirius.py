@@ -24,12 +24,24 @@ class SiriusException(Exception):
         return repr(self.value)
 
 
+class SiriusAuthException(SiriusException):
+    """Signing in or renewing the session failed, the account is at fault"""
+    pass
+
+
+class SiriusNotFoundException(SiriusException):
+    """Upstream has no such resource, say a bitrate tier a channel lacks"""
+    pass
+
+
 class Sirius():
     BASE_URL = 'https://www.siriusxm.com/legacyplayer/'
     HARDWARE_ID = '00000000'
     ETHERNET_MAC = '0000CAFEBABE'
     KEY_LENGTH = 16
     PACKET_AES_KEY = 'D0DB1CA3B300831A301AF9144FC6986A'
+    BITRATES = ('32k', '64k', '96k', '256k')
+    DEFAULT_BITRATE = '64k'
 
 
     def _encrypt(self, plaintext):
@@ -92,14 +104,21 @@ class Sirius():
                     self.lineup[int(channel['siriusChannelNo'])] = channel
 
 
-    def __init__(self):
+    def __init__(self, template=None):
         """
         Creates a new instance of the Sirius player
         At construction, we only get the global config and the channel lineup
+        Given another instance as template, its config and lineup are reused,
+        so an extra session for another account costs no extra requests
         """
         self.backend = default_backend()
         self.token_cache = {}
 
+        if template is not None:
+            self.config = template.config
+            self.lineup = template.lineup
+            return
+
         player_page = requests.get(self.BASE_URL).text
         config_url = re.search("flashvars.configURL = '(.+?)'", player_page)
         if config_url is None:
@@ -170,15 +189,17 @@ class Sirius():
 
         if auth_result['status'] == 0:
             if auth_result['messages']['code'] == 401:
-                raise SiriusException('Invalid password')
+                raise SiriusAuthException('Invalid password')
             else:
-                raise SiriusException('Unknown login error')
+                raise SiriusAuthException('Unknown login error')
 
         self.session_id = auth_result['sessionId']
 
 
-    def _channel_token(self, channel_key, invalidate=False):
-        """Returns a 2-tuple that acts as a stream token"""
+    def _channel_token(self, channel_key, invalidate=False, renewed=False):
+        """Returns a 2-tuple that acts as a stream token
+        Without one the session is renewed once, after that it is given up on
+        """
         if not invalidate and channel_key in self.token_cache:
             return self.token_cache[channel_key]
 
@@ -196,54 +217,75 @@ class Sirius():
                 token_data[6 : 6 + length].decode()).group(1, 2)
             self.token_cache[channel_key] = (channel_url, token)
             return self.token_cache[channel_key]
+        elif renewed:
+            raise SiriusAuthException('No stream token for channel {}'.format(channel_key))
         else:
             self.login(self.username, self.password)
-            return self._channel_token(channel_key, True)
+            return self._channel_token(channel_key, True, True)
 
 
-    def _get_token_resource(self, channel_key, file):
-        """Retrieves a token protected channel resource, returns response object"""
+    def _get_token_resource(self, channel_key, file, bitrate=DEFAULT_BITRATE):
+        """Retrieves a token protected channel resource, returns response object
+        Bitrate picks the variant stream, one of BITRATES
+        """
         channel_url, token = self._channel_token(channel_key)
-        hq_path = '{}HLS_{}_64k/'.format(channel_url, channel_key)
+        hq_path = '{}HLS_{}_{}/'.format(channel_url, channel_key, bitrate)
         resp = requests.get(hq_path + file, params={'token': token})
         if resp.status_code == 200:
             return resp
         elif resp.status_code == 404:
-            raise SiriusException('Resource not found')
+            raise SiriusNotFoundException('Resource not found: {}'.format(file))
         else:
             logging.warning('Expired token, renewing')
             self._channel_token(channel_key, True)
-            return self._get_token_resource(channel_key, file)
+            return self._get_token_resource(channel_key, file, bitrate)
 
 
-    def get_playlist(self, channel_key):
+    def get_playlist(self, channel_key, bitrate=DEFAULT_BITRATE):
         """Retrieve m3u8 playlist for a given channel"""
-        resp = self._get_token_resource(channel_key, str(channel_key) + '_64k_large.m3u8')
+        resp = self._get_token_resource(channel_key,
+            '{}_{}_large.m3u8'.format(channel_key, bitrate), bitrate)
         return resp.text
 
 
-    def get_segment(self, channel_key, segment):
+    def get_segment(self, channel_key, segment, bitrate=DEFAULT_BITRATE):
         """Get a media segment from a channel, return decrypted as MPEG TS"""
-        resp = self._get_token_resource(channel_key, segment)
+        resp = self._get_token_resource(channel_key, segment, bitrate)
         segment = self._decrypt_packet(resp.content)
         return segment
 
 
-    def packet_generator(self, channel_key, rewind=0):
-        """Generator that produces AAC-HE audio in an MPEG-TS container
+    def segment_generator(self, channel_key, rewind=0, bitrate=DEFAULT_BITRATE):
+        """Generator that produces (name, segment) pairs of decrypted MPEG-TS
         See also: HTTP Live Streaming
         Rewind specifies a number of minutes to go back in history
+        Missing segments are skipped, a missing playlist raises SiriusNotFoundException
         """
         playlist = []
         entry = None
         while True:
             if len(playlist) < 3:
-                resp = self.get_playlist(channel_key)
+                resp = self.get_playlist(channel_key, bitrate)
                 new_entries = self._filter_playlist(resp, entry, rewind)
                 playlist += [x for x in new_entries if x not in playlist]
             if len(playlist):
                 entry = playlist.pop(0)
-                logging.debug('Got audio chunk ' + entry)
-                yield self.get_segment(channel_key, entry)
+                try:
+                    segment = self.get_segment(channel_key, entry, bitrate)
+                except SiriusNotFoundException:
+                    # rolled off the playlist before we got to it
+                    logging.info('Audio chunk %s is gone, skipping', entry, extra={'channel': channel_key})
+                    continue
+                logging.debug('Got audio chunk %s', entry, extra={'channel': channel_key})
+                yield entry, segment
             else:
                 time.sleep(10)
+
+
+    def packet_generator(self, channel_key, rewind=0, bitrate=DEFAULT_BITRATE):
+        """Generator that produces AAC-HE audio in an MPEG-TS container
+        See also: HTTP Live Streaming
+        Rewind specifies a number of minutes to go back in history
+        """
+        for entry, segment in self.segment_generator(channel_key, rewind, bitrate):
+            yield segment